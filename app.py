@@ -1,50 +1,80 @@
-import json
-from typing import Optional, Any, List
+from types import MappingProxyType
+from typing import Optional, Any, AsyncIterator, Dict, List, Mapping, Union
 
+import orjson
 import uvicorn
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Extra
 from starlette.middleware.cors import CORSMiddleware
-from flask import Flask, request
+from starlette.requests import Request
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 from dotenv import load_dotenv
 import atexit
+from contextlib import asynccontextmanager
+import functools
+import httpx
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import os
+import queue
+import time
+import uuid
 from pymilvus import MilvusException
 import pymilvus
 from src.constants import (
     ARGS_CONNECTION_ARGS,
+    ERROR_BATCH_TOO_LARGE,
     ERROR_MILVUS_CONNECT_FAILED,
     ERROR_MILVUS_UNKNOWN,
     ERROR_OK,
     ERROR_UNKNOW,
     ERRSTR_MILVUS_CONNECT_FAILED,
 )
-from src.conversation_manager import chat, has_conversation, initialize_conversation
+from src.conversation_manager import (
+    ChatStream,
+    achat,
+)
 
 from src.document_embedder import (
-    get_all_documents,
-    get_connection_status as get_vectorstore_connection_status,
-    new_embedder_document,
-    remove_document,
+    aget_all_documents,
+    aget_connection_status as aget_vectorstore_connection_status,
+    anew_embedder_document,
+    anew_embedder_documents,
+    aremove_document,
 )
-from src.kg_agent import get_connection_status as get_kg_connection_status
+from src.kg_agent import aget_connection_status as aget_kg_connection_status
 from src.utils import get_auth
 from src.job_recycle_conversations import run_scheduled_job_continuously
 
 # prepare logger
-logging.basicConfig(level=logging.INFO)
-file_handler = logging.FileHandler("./logs/app.log")
-file_handler.setLevel(logging.INFO)
-stream_handler = logging.StreamHandler()
-stream_handler.setLevel(logging.INFO)
-formatter = logging.Formatter(
-    "%(asctime)s - %(name)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
-)
-file_handler.setFormatter(formatter)
-stream_handler.setFormatter(formatter)
 root_logger = logging.getLogger()
-root_logger.addHandler(file_handler)
-root_logger.addHandler(stream_handler)
+# app.py can be imported twice in one process (as __main__ and as "app" by
+# uvicorn), only attach the handlers once
+if not getattr(root_logger, "_biochat_configured", False):
+    file_handler = logging.FileHandler("./logs/app.log")
+    file_handler.setLevel(logging.INFO)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setLevel(logging.INFO)
+    formatter = logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    file_handler.setFormatter(formatter)
+    stream_handler.setFormatter(formatter)
+    # handlers write from a background thread, so logging never blocks a
+    # request
+    log_queue = queue.Queue(-1)
+    root_logger._biochat_log_listener = QueueListener(
+        log_queue, file_handler, stream_handler, respect_handler_level=True
+    )
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(QueueHandler(log_queue))
+    root_logger._biochat_log_listener.start()
+    # stopped at exit rather than on lifespan shutdown: the listener lives as
+    # long as the process, and the recycle job still logs after shutdown
+    atexit.register(root_logger._biochat_log_listener.stop)
+    root_logger._biochat_configured = True
 
 
 # run scheduled job: recycle unused session
@@ -57,15 +87,143 @@ def onExit():
 
 atexit.register(onExit)
 
-load_dotenv()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    load_dotenv()
+    # one keep-alive connection pool per process for all OpenAI calls
+    limits = httpx.Limits(max_connections=200, max_keepalive_connections=50)
+    http_client = httpx.Client(limits=limits)
+    async_http_client = httpx.AsyncClient(limits=limits)
+    app.state.http_clients = (http_client, async_http_client)
+    yield
+    http_client.close()
+    await async_http_client.aclose()
+
+
 app = FastAPI(
     # Initialize FastAPI cache with in-memory backend
     title="Biochatter server API",
     version="0.3.0",
     description="API to interact with biochatter server",
     debug=True,
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
+_CONNECT_FAILED = pymilvus.Status.CONNECT_FAILED
+
+
+def error_body(e: Exception) -> dict:
+    if isinstance(e, MilvusException):
+        if e.code == _CONNECT_FAILED:
+            return {
+                "error": ERRSTR_MILVUS_CONNECT_FAILED,
+                "code": ERROR_MILVUS_CONNECT_FAILED,
+            }
+        return {"error": e.message, "code": ERROR_MILVUS_UNKNOWN}
+    return {"error": str(e), "code": ERROR_UNKNOW}
+
+
+# serialised once at load, an unreachable Milvus is the common failure. Only
+# the body is shared: a Response instance cannot be reused, as middlewares
+# append their headers to its header list.
+_ERR_MILVUS_CONNECT = orjson.dumps(
+    {"error": ERRSTR_MILVUS_CONNECT_FAILED, "code": ERROR_MILVUS_CONNECT_FAILED}
+)
+
+
+@app.exception_handler(MilvusException)
+async def handle_milvus_exception(request: Request, e: MilvusException):
+    if e.code == _CONNECT_FAILED:
+        return Response(_ERR_MILVUS_CONNECT, media_type="application/json")
+    return ORJSONResponse(error_body(e))
+
+
+class UnknownErrorMiddleware:
+    """
+    Turn any other exception escaping an endpoint into the usual error body.
+    Starlette ignores exception handlers for plain Exception in debug mode,
+    hence a middleware. Registered before CORS so error responses still get
+    the CORS headers.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        response_started = False
+
+        async def _send(message: Message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        except Exception as e:
+            if response_started:
+                raise e
+            await ORJSONResponse(error_body(e))(scope, receive, send)
+
+
+# headers of every preflight response, built once since the CORS policy is
+# static. Origin and requested headers are echoed back per request: browsers
+# do not accept "*" on credentialed requests (methods are spelled out for the
+# same reason), and a "*" in allow-headers never covers Authorization.
+_PREFLIGHT_HEADERS = [
+    (
+        b"access-control-allow-methods",
+        b"DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT",
+    ),
+    (b"access-control-allow-credentials", b"true"),
+    (b"access-control-max-age", b"86400"),
+    (b"vary", b"Origin"),
+    (b"content-length", b"0"),
+]
+
+
+class PreflightMiddleware:
+    """
+    Answer CORS preflight requests straight away with the precomputed
+    headers, CORSMiddleware still handles the simple requests.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] != "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        origin = headers.get(b"origin")
+        if origin is None or b"access-control-request-method" not in headers:
+            # a plain OPTIONS request, not a preflight
+            await self.app(scope, receive, send)
+            return
+        response_headers = _PREFLIGHT_HEADERS + [
+            (b"access-control-allow-origin", origin),
+        ]
+        requested_headers = headers.get(b"access-control-request-headers")
+        if requested_headers is not None:
+            response_headers.append(
+                (b"access-control-allow-headers", requested_headers)
+            )
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": response_headers,
+        })
+        await send({"type": "http.response.body", "body": b""})
+
+
+app.add_middleware(UnknownErrorMiddleware)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -73,101 +231,224 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all methods
     allow_headers=["*"],  # Allows all headers
+    max_age=86400,  # same as PreflightMiddleware
+)
+# outermost, so preflights skip the rest of the stack
+app.add_middleware(PreflightMiddleware)
+
+
+# read-only, so a request can never leak changes into the defaults of the next
+DEFAULT_RAGCONFIG = MappingProxyType(
+    {
+        "splitByChar": True,
+        "chunkSize": 1000,
+        "overlapSize": 0,
+        "resultNum": 3,
+        ARGS_CONNECTION_ARGS: MappingProxyType({}),
+    }
 )
-
-
-DEFAULT_RAGCONFIG = {
-    "splitByChar": True,
-    "chunkSize": 1000,
-    "overlapSize": 0,
-    "resultNum": 3,
-}
 RAG_KG = "KG"
 RAG_VECTORSTORE = "VS"
+MAX_BATCH_SIZE = 100
 
 
-def process_connection_args(rag: str, connection_args: dict) -> dict:
-    if rag == RAG_VECTORSTORE:
-        if connection_args.get("host", "").lower() == "local":
-            connection_args["host"] = (
-                "127.0.0.1" if "HOST" not in os.environ else os.environ["HOST"]
-            )
-    elif rag == RAG_KG:
-        if connection_args.get("host", "").lower() == "local":
-            connection_args["host"] = (
-                "127.0.0.1" if "KGHOST" not in os.environ else os.environ["KGHOST"]
-            )
-    return connection_args
+# environment variables holding the host that "local" stands for, read on
+# first use since .env is only loaded at startup
+_LOCAL_HOST_ENVS = {RAG_VECTORSTORE: "HOST", RAG_KG: "KGHOST"}
 
 
-def extract_and_process_params_from_json_body(
-    json: Optional[dict], name: str, defaultVal: Optional[Any]
-) -> Optional[Any]:
-    if not json:
-        return defaultVal
-    val = json.get(name, defaultVal)
-    return val
+@functools.lru_cache(maxsize=64)
+def _resolve_connection_args(rag: str, connection_args: tuple) -> tuple:
+    resolved = dict(connection_args)
+    if str(resolved.get("host", "")).lower() == "local":
+        resolved["host"] = os.environ.get(_LOCAL_HOST_ENVS[rag], "127.0.0.1")
+    return tuple(resolved.items())
 
 
-@app.post("/v1/chat/completions", description="chat completions")
-def handle():
-    auth = get_auth(request)
-    jsonBody = request.json
-    sessionId = extract_and_process_params_from_json_body(
-        jsonBody, "session_id", defaultVal=""
-    )
-    messages = extract_and_process_params_from_json_body(
-        jsonBody, "messages", defaultVal=[]
-    )
-    model = extract_and_process_params_from_json_body(
-        jsonBody, "model", defaultVal="gpt-3.5-turbo"
-    )
-    temperature = extract_and_process_params_from_json_body(
-        jsonBody, "temperature", defaultVal=0.7
-    )
-    presence_penalty = extract_and_process_params_from_json_body(
-        jsonBody, "presence_penalty", defaultVal=0
-    )
-    frequency_penalty = extract_and_process_params_from_json_body(
-        jsonBody, "frequency_penalty", defaultVal=0
-    )
-    top_p = extract_and_process_params_from_json_body(jsonBody, "top_p", defaultVal=1)
-    ragConfig = extract_and_process_params_from_json_body(
-        jsonBody, "ragConfig", defaultVal=DEFAULT_RAGCONFIG
-    )
-    ragConfig[ARGS_CONNECTION_ARGS] = process_connection_args(
-        RAG_VECTORSTORE, ragConfig[ARGS_CONNECTION_ARGS]
-    )
-    useRAG = extract_and_process_params_from_json_body(
-        jsonBody, "useRAG", defaultVal=False
-    )
-    kgConfig = extract_and_process_params_from_json_body(
-        jsonBody, "kgConfig", defaultVal={}
-    )
-    kgConfig[ARGS_CONNECTION_ARGS] = process_connection_args(
-        RAG_KG, kgConfig[ARGS_CONNECTION_ARGS]
-    )
-    useKG = extract_and_process_params_from_json_body(
-        jsonBody, "useKG", defaultVal=False
+def process_connection_args(
+    rag: str, connection_args: Optional[Mapping]
+) -> Optional[dict]:
+    if connection_args is None:
+        return None
+    items = tuple(connection_args.items())
+    try:
+        return dict(_resolve_connection_args(rag, items))
+    except TypeError:
+        # unhashable values (e.g. lists) cannot be cached
+        return dict(_resolve_connection_args.__wrapped__(rag, items))
+
+
+def build_rag_config(ragConfig: Optional[Union[Mapping, str]]) -> dict:
+    """
+    Merge the request's ragConfig over DEFAULT_RAGCONFIG into a new dict and
+    resolve its connection args.
+    """
+    if isinstance(ragConfig, str):
+        ragConfig = orjson.loads(ragConfig)
+    config = {**DEFAULT_RAGCONFIG, **(ragConfig or {})}
+    # a null connectionArgs falls back to the default, like a missing one
+    config[ARGS_CONNECTION_ARGS] = process_connection_args(
+        RAG_VECTORSTORE, config[ARGS_CONNECTION_ARGS] or {}
     )
+    return config
+
 
-    if not has_conversation(sessionId):
-        initialize_conversation(
-            sessionId=sessionId,
-            modelConfig={
-                "temperature": temperature,
-                "presence_penalty": presence_penalty,
-                "frequency_penalty": frequency_penalty,
-                "top_p": top_p,
-                "model": model,
-                "auth": auth,
-            },
+def build_kg_config(kgConfig: Optional[Mapping]) -> dict:
+    config = {**(kgConfig or {})}
+    if config.get(ARGS_CONNECTION_ARGS) is None:
+        # no knowledge graph to connect to
+        config.pop(ARGS_CONNECTION_ARGS, None)
+    else:
+        config[ARGS_CONNECTION_ARGS] = process_connection_args(
+            RAG_KG, config[ARGS_CONNECTION_ARGS]
         )
+    return config
+
+
+class RequestModel(BaseModel):
+    class Config:
+        extra = Extra.ignore
+
+
+class ChatRequest(RequestModel):
+    session_id: str = ""
+    messages: List[Dict[str, Any]] = []
+    model: str = "gpt-3.5-turbo"
+    temperature: float = 0.7
+    presence_penalty: float = 0
+    frequency_penalty: float = 0
+    top_p: float = 1
+    ragConfig: Optional[Dict[str, Any]] = None
+    useRAG: bool = False
+    kgConfig: Optional[Dict[str, Any]] = None
+    useKG: bool = False
+    stream: bool = False
+
+
+class NewDocumentRequest(RequestModel):
+    tmpFile: str = ""
+    filename: str = ""
+    # some clients send ragConfig as a JSON encoded string
+    ragConfig: Optional[Union[Dict[str, Any], str]] = None
+
+
+class DocumentFile(RequestModel):
+    tmpFile: str = ""
+    filename: str = ""
+
+
+class NewDocumentsRequest(RequestModel):
+    files: List[DocumentFile] = []
+    ragConfig: Optional[Union[Dict[str, Any], str]] = None
+
+
+class DocumentsRequest(RequestModel):
+    connectionArgs: Optional[Dict[str, Any]] = None
+    docIds: Optional[List[str]] = None
+
+
+class RemoveDocumentRequest(DocumentsRequest):
+    docId: str = ""
+
+
+class ConnectionStatusRequest(RequestModel):
+    connectionArgs: Optional[Dict[str, Any]] = None
+
+
+def _sse_event(data: Any) -> bytes:
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+
+async def sse_formatter(model: str, stream: ChatStream) -> AsyncIterator[bytes]:
+    """
+    Frame streamed reply deltas as OpenAI chat.completion.chunk events. The
+    closing chunk also carries the injected contexts, and errors raised
+    mid-stream are sent as an event since the status line is already out.
+    """
+    chunk = {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+    }
     try:
-        (msg, usage, contexts) = chat(
-            sessionId, messages, auth, ragConfig, useRAG, kgConfig, useKG
+        async for delta in stream:
+            yield _sse_event(
+                {
+                    **chunk,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "delta": {"role": "assistant", "content": delta},
+                            "finish_reason": None,
+                        }
+                    ],
+                }
+            )
+        yield _sse_event(
+            {
+                **chunk,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                "contexts": stream.contexts,
+                "code": ERROR_OK,
+            }
         )
-        return {
+    except Exception as e:
+        yield _sse_event(error_body(e))
+    yield b"data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions", description="chat completions", response_model=None)
+async def handle(request: Request, body: ChatRequest):
+    auth = get_auth(request)
+    sessionId = body.session_id
+    messages = body.messages
+    ragConfig = build_rag_config(body.ragConfig)
+    useRAG = body.useRAG
+    kgConfig = build_kg_config(body.kgConfig)
+    useKG = body.useKG
+
+    # used if the session is new; it is created on a worker thread as that
+    # can validate the API key online
+    modelConfig = {
+        "temperature": body.temperature,
+        "presence_penalty": body.presence_penalty,
+        "frequency_penalty": body.frequency_penalty,
+        "top_p": body.top_p,
+        "model": body.model,
+        "auth": auth,
+    }
+    if body.stream:
+        return StreamingResponse(
+            sse_formatter(
+                body.model,
+                ChatStream(
+                    sessionId,
+                    messages,
+                    auth,
+                    ragConfig,
+                    useRAG,
+                    kgConfig,
+                    useKG,
+                    request.app.state.http_clients,
+                    modelConfig,
+                ),
+            ),
+            media_type="text/event-stream",
+        )
+    (msg, usage, contexts) = await achat(
+        sessionId,
+        messages,
+        auth,
+        ragConfig,
+        useRAG,
+        kgConfig,
+        useKG,
+        request.app.state.http_clients,
+        modelConfig,
+    )
+    return ORJSONResponse(
+        {
             "choices": [
                 {
                     "index": 0,
@@ -179,148 +460,137 @@ def handle():
             "contexts": contexts,
             "code": ERROR_OK,
         }
-    except MilvusException as e:
-        if e.code == pymilvus.Status.CONNECT_FAILED:
-            return {
-                "error": ERRSTR_MILVUS_CONNECT_FAILED,
-                "code": ERROR_MILVUS_CONNECT_FAILED,
-            }
-        else:
-            return {"error": e.message, "code": ERROR_MILVUS_UNKNOWN}
-    except Exception as e:
-        return {"error": str(e)}
+    )
 
 
-@app.post("/v1/rag/newdocument", description="creates new document")
-def newDocument():
-    jsonBody = request.json
-    tmpFile = extract_and_process_params_from_json_body(jsonBody, "tmpFile", "")
-    filename = extract_and_process_params_from_json_body(jsonBody, "filename", "")
-    ragConfig = extract_and_process_params_from_json_body(
-        jsonBody, "ragConfig", DEFAULT_RAGCONFIG
-    )
-    if type(ragConfig) is str:
-        ragConfig = json.loads(ragConfig)
-    ragConfig[ARGS_CONNECTION_ARGS] = process_connection_args(
-        RAG_VECTORSTORE, ragConfig[ARGS_CONNECTION_ARGS]
-    )
+@app.post(
+    "/v1/rag/newdocument", description="creates new document", response_model=None
+)
+async def newDocument(request: Request, body: NewDocumentRequest):
+    tmpFile = body.tmpFile
+    filename = body.filename
+    ragConfig = build_rag_config(body.ragConfig)
     auth = get_auth(request)
     # TODO: consider to be compatible with XinferenceDocumentEmbedder
-    try:
-        doc_id = new_embedder_document(
-            authKey=auth, tmpFile=tmpFile, filename=filename, rag_config=ragConfig
-        )
-        return {"id": doc_id, "code": ERROR_OK}
-    except MilvusException as e:
-        if e.code == pymilvus.Status.CONNECT_FAILED:
-            return {
-                "error": ERRSTR_MILVUS_CONNECT_FAILED,
-                "code": ERROR_MILVUS_CONNECT_FAILED,
+    doc_id = await anew_embedder_document(
+        authKey=auth, tmpFile=tmpFile, filename=filename, rag_config=ragConfig
+    )
+    return ORJSONResponse({"id": doc_id, "code": ERROR_OK})
+
+
+@app.post(
+    "/v1/rag/newdocuments",
+    description="creates new documents in one batch",
+    response_model=None,
+)
+async def newDocuments(request: Request, body: NewDocumentsRequest):
+    def post_process(filename: str, res: Any) -> dict:
+        if isinstance(res, BaseException):
+            return {"file": filename, **error_body(res)}
+        return {"file": filename, "id": res, "code": ERROR_OK}
+
+    files = body.files
+    if len(files) > MAX_BATCH_SIZE:
+        return ORJSONResponse(
+            {
+                "error": f"At most {MAX_BATCH_SIZE} files can be added in one batch",
+                "code": ERROR_BATCH_TOO_LARGE,
             }
-        else:
-            return {"error": e.message, "code": ERROR_MILVUS_UNKNOWN}
-    except Exception as e:
-        return {"error": str(e), "code": ERROR_UNKNOW}
+        )
+    ragConfig = build_rag_config(body.ragConfig)
+    auth = get_auth(request)
+    filenames = [file.filename for file in files]
+    results = await anew_embedder_documents(
+        authKey=auth,
+        files=[(file.tmpFile, file.filename) for file in files],
+        rag_config=ragConfig,
+    )
+    return ORJSONResponse(
+        {
+            "results": [
+                post_process(filename, res)
+                for (filename, res) in zip(filenames, results)
+            ],
+            "code": ERROR_OK,
+        }
+    )
 
 
-@app.post("/v1/rag/alldocuments", description="retrieves all documents")
-def getAllDocuments():
+@app.post(
+    "/v1/rag/alldocuments", description="retrieves all documents", response_model=None
+)
+async def getAllDocuments(request: Request, body: DocumentsRequest):
     def post_process(docs: List[Any]):
         for doc in docs:
             doc["id"] = str(doc["id"])
         return docs
 
     auth = get_auth(request)
-    jsonBody = request.json
-    connection_args = extract_and_process_params_from_json_body(
-        jsonBody, ARGS_CONNECTION_ARGS, None
-    )
-    connection_args = process_connection_args(RAG_VECTORSTORE, connection_args)
-    doc_ids = extract_and_process_params_from_json_body(jsonBody, "docIds", None)
-    try:
-        docs = get_all_documents(auth, connection_args, doc_ids=doc_ids)
-        docs = post_process(docs)
-        return {"documents": docs, "code": ERROR_OK}
-    except MilvusException as e:
-        if e.code == pymilvus.Status.CONNECT_FAILED:
-            return {
-                "error": ERRSTR_MILVUS_CONNECT_FAILED,
-                "code": ERROR_MILVUS_CONNECT_FAILED,
-            }
-        else:
-            return {"error": e.message, "code": ERROR_MILVUS_UNKNOWN}
-    except Exception as e:
-        return {"error": str(e), "code": ERROR_UNKNOW}
+    connection_args = process_connection_args(RAG_VECTORSTORE, body.connectionArgs)
+    doc_ids = body.docIds
+    docs = await aget_all_documents(auth, connection_args, doc_ids=doc_ids)
+    docs = post_process(docs)
+    return ORJSONResponse({"documents": docs, "code": ERROR_OK})
 
 
-@app.delete("/v1/rag/document", description="removes a document")
-def removeDocument():
-    jsonBody = request.json
+@app.delete("/v1/rag/document", description="removes a document", response_model=None)
+async def removeDocument(request: Request, body: RemoveDocumentRequest):
     auth = get_auth(request)
-    docId = extract_and_process_params_from_json_body(jsonBody, "docId", "")
-    connection_args = extract_and_process_params_from_json_body(
-        jsonBody, ARGS_CONNECTION_ARGS, None
-    )
-    connection_args = process_connection_args(RAG_VECTORSTORE, connection_args)
-    doc_ids = extract_and_process_params_from_json_body(jsonBody, "docIds", None)
+    docId = body.docId
+    connection_args = process_connection_args(RAG_VECTORSTORE, body.connectionArgs)
+    doc_ids = body.docIds
     if len(docId) == 0:
-        return {"error": "Failed to find document"}
-    try:
-        remove_document(
-            docId, authKey=auth, connection_args=connection_args, doc_ids=doc_ids
-        )
-        return {"id": docId, "code": ERROR_OK}
-    except MilvusException as e:
-        if e.code == pymilvus.Status.CONNECT_FAILED:
-            return {
-                "error": ERRSTR_MILVUS_CONNECT_FAILED,
-                "code": ERROR_MILVUS_CONNECT_FAILED,
-            }
-        else:
-            return {"error": e.message, "code": ERROR_MILVUS_UNKNOWN}
-    except Exception as e:
-        return {"error": str(e), "code": ERROR_UNKNOW}
+        return ORJSONResponse({"error": "Failed to find document"})
+    await aremove_document(
+        docId, authKey=auth, connection_args=connection_args, doc_ids=doc_ids
+    )
+    return ORJSONResponse({"id": docId, "code": ERROR_OK})
 
 
-@app.post("/v1/rag/connectionstatus", description="returns connection status")
-def getConnectionStatus():
-    try:
-        auth = get_auth(request)
-        jsonBody = request.json
-        connection_args = extract_and_process_params_from_json_body(
-            jsonBody, ARGS_CONNECTION_ARGS, None
-        )
-        connection_args = process_connection_args(RAG_VECTORSTORE, connection_args)
-        connected = get_vectorstore_connection_status(connection_args, auth)
-        return {
+@app.post(
+    "/v1/rag/connectionstatus",
+    description="returns connection status",
+    response_model=None,
+)
+async def getConnectionStatus(request: Request, body: ConnectionStatusRequest):
+    auth = get_auth(request)
+    connection_args = process_connection_args(RAG_VECTORSTORE, body.connectionArgs)
+    connected = await aget_vectorstore_connection_status(connection_args, auth)
+    return ORJSONResponse(
+        {
             "status": "connected" if connected else "disconnected",
             "code": ERROR_OK,
         }
-    except MilvusException as e:
-        return {"error": e.message, "code": ERROR_MILVUS_UNKNOWN}
-    except Exception as e:
-        return {"error": str(e), "code": ERROR_UNKNOW}
+    )
 
 
 @app.post(
-    "/v1/kg/connectionstatus", description="returns knowledge graph connection status"
+    "/v1/kg/connectionstatus",
+    description="returns knowledge graph connection status",
+    response_model=None,
 )
-def getKGConnectionStatus():
-    try:
-        jsonBody = request.json
-        connection_args = extract_and_process_params_from_json_body(
-            jsonBody, ARGS_CONNECTION_ARGS, None
-        )
-        connection_args = process_connection_args(RAG_KG, connection_args)
-        connected = get_kg_connection_status(connection_args)
-        return {
+async def getKGConnectionStatus(body: ConnectionStatusRequest):
+    connection_args = process_connection_args(RAG_KG, body.connectionArgs)
+    connected = await aget_kg_connection_status(connection_args)
+    return ORJSONResponse(
+        {
             "status": "connected" if connected else "disconnected",
             "code": ERROR_OK,
         }
-    except Exception as e:
-        return {"error": str(e), "code": ERROR_UNKNOW}
+    )
 
 
 if __name__ == "__main__":
     port: int = 5001
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # workers need the import string; log_config=None leaves logging to the
+    # queue handlers above, which every worker sets up on import. "auto"
+    # picks uvloop and httptools where they are installed (not on Windows)
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=port,
+        loop="auto",
+        http="auto",
+        workers=int(os.environ.get("WORKERS", os.cpu_count() or 1)),
+        log_config=None,
+    )
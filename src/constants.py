@@ -9,6 +9,7 @@ OPENAI_API_KEY="OPENAI_API_KEY"
 # error
 ERROR_OK = 0
 ERROR_UNKNOW = 5000
+ERROR_BATCH_TOO_LARGE = 5001
 ERROR_MILVUS_UNKNOWN = 5101
 ERROR_MILVUS_CONNECT_FAILED = 5102
 
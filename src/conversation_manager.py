@@ -1,7 +1,9 @@
+import asyncio
+import httpx
 import os
 from datetime import datetime
 import logging
-from typing import Optional, Dict, List, Any
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 from biochatter.llm_connect import (
     AzureGptConversation,
     GptConversation,
@@ -11,6 +13,7 @@ from biochatter.rag_agent import RagAgent, RagAgentModeEnum
 from pprint import pprint
 import threading
 from threading import RLock
+from concurrent.futures import ThreadPoolExecutor
 from src.constants import (
     ARGS_CONNECTION_ARGS,
     ARGS_DOCIDS_WORKSPACE,
@@ -26,6 +29,7 @@ from src.kg_agent import find_schema_info_node
 from src.utils import (
     get_azure_embedding_deployment,
     get_embedding_function,
+    get_limit_semaphore,
     get_rag_agent_prompts,
 )
 
@@ -46,6 +50,62 @@ defaultModelConfig = {
 
 MAX_AGE = 3 * 24 * 3600 * 1000  # 3 days
 
+# runs the vector store and knowledge graph agents of a chat side by side
+_rag_executor = ThreadPoolExecutor(thread_name_prefix="rag")
+
+# shared (sync, async) connection pools for the OpenAI API, see app lifespan
+HttpClients = Tuple[httpx.Client, httpx.AsyncClient]
+
+
+def _openai_semaphore() -> asyncio.Semaphore:
+    # bounds the chats in flight against the OpenAI API, so a burst of
+    # requests queues here instead of running into rate limits
+    return get_limit_semaphore("OAI_MAX_INFLIGHT", 32)
+
+
+def _generate_responses(agent: RagAgent, text: str) -> List[tuple]:
+    try:
+        return agent.generate_responses(text)
+    except ValueError as e:
+        logger.warning(e)
+        return []
+
+
+class ConcurrentRagMixin:
+    """
+    Same as Conversation._inject_context(), but queries the vector store and
+    the knowledge graph concurrently instead of one after the other.
+    """
+
+    def _inject_context(self, text: str):
+        statements = []
+        for docs in _rag_executor.map(
+            _generate_responses, self.rag_agents, [text] * len(self.rag_agents)
+        ):
+            statements = statements + [doc[0] for doc in docs]
+
+        if statements and len(statements) > 0:
+            prompts = self.prompts["rag_agent_prompts"]
+            self.current_statements = statements
+            for i, prompt in enumerate(prompts):
+                # if last prompt, format the statements into the prompt
+                if i == len(prompts) - 1:
+                    self.append_system_message(prompt.format(statements=statements))
+                else:
+                    self.append_system_message(prompt)
+
+
+class ServerAzureGptConversation(ConcurrentRagMixin, AzureGptConversation):
+    pass
+
+
+class ServerGptConversation(ConcurrentRagMixin, GptConversation):
+    pass
+
+
+class ServerWasmConversation(ConcurrentRagMixin, WasmConversation):
+    pass
+
 
 class SessionData:
     def __init__(
@@ -59,6 +119,10 @@ class SessionData:
         self.createdAt = int(datetime.now().timestamp() * 1000)  # in milliseconds
         self.refreshedAt = self.createdAt
         self.maxAge = MAX_AGE
+        self.apiKey = None
+        # serialises the queries of this session, held by chat() and for the
+        # whole of a streamed reply
+        self.lock = threading.Lock()
         self.chatter = self._create_conversation()
 
     def chat(
@@ -69,7 +133,75 @@ class SessionData:
         useRAG: bool = False,
         kgConfig: dict = None,
         useKG: bool = False,
+        httpClients: Optional[HttpClients] = None,
     ):
+        text = self._prepare_query(
+            messages, authKey, ragConfig, useRAG, kgConfig, useKG, httpClients
+        )
+        if text is None:
+            return
+        try:
+            (msg, usage, _) = self.chatter.query(text)
+            contexts = self.chatter.get_last_injected_context()
+            return (msg, usage, contexts)
+        except Exception as e:
+            logger.error(e)
+            raise e
+
+    def prepare_stream(
+        self,
+        messages: List[str],
+        authKey: str,
+        ragConfig: dict,
+        useRAG: bool = False,
+        kgConfig: dict = None,
+        useKG: bool = False,
+        httpClients: Optional[HttpClients] = None,
+    ) -> Optional[str]:
+        """
+        Blocking half of a streamed chat: set up the conversation, add the
+        user query and inject the RAG/KG context. Returns the query text, or
+        None if there is nothing to answer.
+        """
+        text = self._prepare_query(
+            messages, authKey, ragConfig, useRAG, kgConfig, useKG, httpClients
+        )
+        if text is None or not hasattr(self.chatter, "chat"):
+            # conversations without a chat model (e.g. wasm) are answered
+            # in one piece by stream()
+            return text
+        self.chatter.append_user_message(text)
+        self.chatter._inject_context(text)
+        return text
+
+    async def stream(self, text: str) -> AsyncIterator[str]:
+        """
+        Yield the reply to a query set up by prepare_stream() as it is
+        generated. The answer is not sent to the correcting agent.
+        """
+        if not hasattr(self.chatter, "chat"):
+            (msg, _, _) = await asyncio.to_thread(self.chatter.query, text)
+            yield msg
+            return
+        deltas = []
+        async for chunk in self.chatter.chat.astream(self.chatter.messages):
+            deltas.append(chunk.content)
+            yield chunk.content
+        self.chatter.append_ai_message("".join(deltas))
+
+    def get_last_contexts(self) -> List[dict]:
+        return self.chatter.get_last_injected_context()
+
+    def _prepare_query(
+        self,
+        messages: List[str],
+        authKey: str,
+        ragConfig: dict,
+        useRAG: bool = False,
+        kgConfig: dict = None,
+        useKG: bool = False,
+        httpClients: Optional[HttpClients] = None,
+    ) -> Optional[str]:
         if self.chatter is None:
             return
         if not messages or len(messages) == 0:
@@ -80,14 +212,18 @@ class SessionData:
         ):  # chatter is instance of GptConversation
             import openai
 
-            if not openai.api_key or not hasattr(self.chatter, "chat"):
+            # set_api_key() validates the key online and builds new clients,
+            # so only do it when the key changes
+            if not hasattr(self.chatter, "chat") or self.apiKey != api_key:
                 if not authKey:
-                    return False
+                    return
                 # save api_key to os.environ to facilitate conversation_factory
                 # to create conversation
                 if isinstance(self.chatter, GptConversation):
                     os.environ["OPENAI_API_KEY"] = api_key
                 self.chatter.set_api_key(api_key, self.sessionId)
+                self.apiKey = api_key
+                self._share_http_clients(api_key, httpClients)
 
         self._update_rags(
             useRAG=useRAG,
@@ -100,13 +236,42 @@ class SessionData:
         messages = messages[:-1]
         # pprint(messages)
         self._setup_messages(messages)
-        try:
-            (msg, usage, _) = self.chatter.query(text)
-            contexts = self.chatter.get_last_injected_context()
-            return (msg, usage, contexts)
-        except Exception as e:
-            logger.error(e)
-            raise e
+        return text
+
+    def _share_http_clients(
+        self, api_key: str, httpClients: Optional[HttpClients]
+    ):
+        """
+        Point the conversation's chat models at the server-wide connection
+        pools instead of the per-model clients created by set_api_key().
+        """
+        if httpClients is None or not isinstance(self.chatter, GptConversation):
+            return
+        import openai
+
+        (http_client, async_http_client) = httpClients
+        for chat_model in [
+            getattr(self.chatter, "chat", None),
+            getattr(self.chatter, "ca_chat", None),
+        ]:
+            if chat_model is None:
+                continue
+            # keep every client setting langchain configured, swap only the pool
+            client_params = {
+                "api_key": api_key,
+                "organization": chat_model.openai_organization,
+                "base_url": chat_model.openai_api_base,
+                "timeout": chat_model.request_timeout,
+                "max_retries": chat_model.max_retries,
+                "default_headers": chat_model.default_headers,
+                "default_query": chat_model.default_query,
+            }
+            chat_model.client = openai.OpenAI(
+                **client_params, http_client=http_client
+            ).chat.completions
+            chat_model.async_client = openai.AsyncOpenAI(
+                **client_params, http_client=async_http_client
+            ).chat.completions
 
     def _setup_messages(self, openai_msgs: List[Any]):
         if self.chatter is None:
@@ -123,7 +288,7 @@ class SessionData:
     def _create_conversation(self):
         if OPENAI_API_TYPE in os.environ and os.environ[OPENAI_API_TYPE] == "azure":
             logger.info("create AzureGptConversation")
-            chatter = AzureGptConversation(
+            chatter = ServerAzureGptConversation(
                 deployment_name=os.environ[OPENAI_DEPLOYMENT_NAME],
                 model_name=os.environ[OPENAI_MODEL],
                 prompts={"rag_agent_prompts": get_rag_agent_prompts()},
@@ -137,10 +302,10 @@ class SessionData:
             or self.modelConfig["model"] == "mistral-wasm"
         ):
             logger.info("create WasmConversation")
-            chatter = WasmConversation("mistral-wasm", prompts={})
+            chatter = ServerWasmConversation("mistral-wasm", prompts={})
         else:
             logger.info("create GptConversation")
-            chatter = GptConversation(
+            chatter = ServerGptConversation(
                 "gpt-3.5-turbo", prompts={"rag_agent_prompts": get_rag_agent_prompts()}
             )
             temp_api_key = os.environ.get("OPENAI_API_KEY", None)
@@ -149,7 +314,15 @@ class SessionData:
         return chatter
 
     def _update_rags(self, useRAG: bool, ragConfig: dict, useKG: bool, kgConfig: dict):
-        # update rag_agent
+        # both agents connect to their database when created, so set them up
+        # side by side; keep the vector store agent first in rag_agents
+        vs_future = _rag_executor.submit(self._create_vs_agent, useRAG, ragConfig)
+        kg_future = _rag_executor.submit(self._create_kg_agent, useKG, kgConfig)
+        for agent in [vs_future.result(), kg_future.result()]:
+            if agent is not None:
+                self.chatter.set_rag_agent(agent)
+
+    def _create_vs_agent(self, useRAG: bool, ragConfig: dict) -> Optional[RagAgent]:
         try:
             (is_azure, azure_deployment, endpoint) = get_azure_embedding_deployment()
             doc_ids = ragConfig.get(ARGS_DOCIDS_WORKSPACE, None)
@@ -158,28 +331,27 @@ class SessionData:
                 azure_deployment=azure_deployment,
                 azure_endpoint=endpoint,
             )
-            self.chatter.set_rag_agent(
-                RagAgent(
-                    mode=RagAgentModeEnum.VectorStore,
-                    model_name=os.environ.get(OPENAI_MODEL, "gpt-3.5-turbo"),
-                    connection_args=ragConfig[ARGS_CONNECTION_ARGS],
-                    use_prompt=useRAG,
-                    embedding_func=embedding_func,
-                    documentids_workspace=doc_ids,
-                    n_results=ragConfig.get(ARGS_RESULT_NUM, 3),
-                )
+            return RagAgent(
+                mode=RagAgentModeEnum.VectorStore,
+                model_name=os.environ.get(OPENAI_MODEL, "gpt-3.5-turbo"),
+                connection_args=ragConfig[ARGS_CONNECTION_ARGS],
+                use_prompt=useRAG,
+                embedding_func=embedding_func,
+                documentids_workspace=doc_ids,
+                n_results=ragConfig.get(ARGS_RESULT_NUM, 3),
             )
         except Exception as e:
             logger.error(e)
+            return None
 
-        # update kg
+    def _create_kg_agent(self, useKG: bool, kgConfig: dict) -> Optional[RagAgent]:
         if not kgConfig or "connectionArgs" not in kgConfig:
-            return
+            return None
         try:
             schema_info = find_schema_info_node(kgConfig["connectionArgs"])
             if not schema_info:
-                return
-            kg_agent = RagAgent(
+                return None
+            return RagAgent(
                 mode=RagAgentModeEnum.KG,
                 model_name=os.environ.get(OPENAI_MODEL, "gpt-3.5-turbo"),
                 connection_args=kgConfig["connectionArgs"],
@@ -188,24 +360,26 @@ class SessionData:
                 conversation_factory=self._create_conversation,
                 n_results=kgConfig.get(ARGS_RESULT_NUM, 3)
             )
-            self.chatter.set_rag_agent(kg_agent)
         except Exception as e:
             logger.error(e)
+            return None
 
 
 conversationsDict = {}
 
 
 def initialize_conversation(sessionId: str, modelConfig: dict):
-    rlock.acquire()
     try:
-        conversationsDict[sessionId] = SessionData(
+        conversation = SessionData(
             sessionId=sessionId,
             modelConfig=modelConfig,
         )
     except Exception as e:
         logger.error(e)
         raise e
+    rlock.acquire()
+    try:
+        conversationsDict[sessionId] = conversation
     finally:
         rlock.release()
 
@@ -218,15 +392,32 @@ def has_conversation(sessionId: str) -> bool:
         rlock.release()
 
 
-def get_conversation(sessionId: str) -> Optional[SessionData]:
+def get_conversation(
+    sessionId: str, modelConfig: Optional[dict] = None
+) -> Optional[SessionData]:
+    """
+    Return the session's conversation, creating it with `modelConfig` (or
+    the default config) if there is none yet. Creating a conversation can
+    validate the API key online, so it happens outside of rlock.
+    """
     rlock.acquire()
     try:
-        if sessionId not in conversationsDict:
-            initialize_conversation(sessionId, defaultModelConfig.copy())
-        return conversationsDict[sessionId]
+        if sessionId in conversationsDict:
+            return conversationsDict[sessionId]
+    finally:
+        rlock.release()
+    try:
+        conversation = SessionData(
+            sessionId=sessionId,
+            modelConfig=modelConfig or defaultModelConfig.copy(),
+        )
     except Exception as e:
         logger.error(e)
         raise e
+    rlock.acquire()
+    try:
+        # another request may have created the session meanwhile
+        return conversationsDict.setdefault(sessionId, conversation)
     finally:
         rlock.release()
 
@@ -251,28 +442,136 @@ def chat(
     useRAG: bool,
     kgConfig: dict,
     useKG: bool,
+    httpClients: Optional[HttpClients] = None,
+    modelConfig: Optional[dict] = None,
 ):
-    rlock.acquire()
     try:
-        conversation = get_conversation(sessionId=sessionId)
+        conversation = get_conversation(
+            sessionId=sessionId, modelConfig=modelConfig
+        )
         logger.info(
             f"get conversation for session id {sessionId}, "
             "type of conversation is SessionData "
             f"{isinstance(conversation, SessionData)}"
         )
-        return conversation.chat(
+        # only this session is locked, chats of other sessions go on
+        with conversation.lock:
+            return conversation.chat(
+                messages=messages,
+                authKey=authKey,
+                ragConfig=ragConfig,
+                useRAG=useRAG,
+                kgConfig=kgConfig,
+                useKG=useKG,
+                httpClients=httpClients,
+            )
+    except Exception as e:
+        logger.error(e)
+        raise e
+
+
+async def achat(
+    sessionId: str,
+    messages: List[str],
+    authKey: str,
+    ragConfig: dict,
+    useRAG: bool,
+    kgConfig: dict,
+    useKG: bool,
+    httpClients: Optional[HttpClients] = None,
+    modelConfig: Optional[dict] = None,
+):
+    # biochatter conversations only expose a blocking query(), so run it
+    # off the event loop instead of tying up the whole handler
+    async with _openai_semaphore():
+        return await asyncio.to_thread(
+            chat,
+            sessionId,
+            messages,
+            authKey,
+            ragConfig,
+            useRAG,
+            kgConfig,
+            useKG,
+            httpClients,
+            modelConfig,
+        )
+
+
+async def _acquire(lock: threading.Lock):
+    """Wait for a threading lock without blocking the event loop."""
+    if lock.acquire(blocking=False):
+        return
+    acquiring = asyncio.ensure_future(asyncio.to_thread(lock.acquire))
+    try:
+        await asyncio.shield(acquiring)
+    except asyncio.CancelledError:
+        # the worker thread still takes the lock, hand it back
+        acquiring.add_done_callback(lambda _: lock.release())
+        raise
+
+
+class ChatStream:
+    """
+    A chat answered as a stream: iterate it for the reply deltas, afterwards
+    `contexts` holds the contexts injected into the query. The session stays
+    locked from setting up the query until the reply has been stored, so a
+    concurrent request cannot reset the messages being streamed.
+    """
+
+    def __init__(
+        self,
+        sessionId: str,
+        messages: List[str],
+        authKey: str,
+        ragConfig: dict,
+        useRAG: bool,
+        kgConfig: dict,
+        useKG: bool,
+        httpClients: Optional[HttpClients] = None,
+        modelConfig: Optional[dict] = None,
+    ):
+        self.sessionId = sessionId
+        self.modelConfig = modelConfig
+        self.contexts: List[dict] = []
+        self._query = dict(
             messages=messages,
             authKey=authKey,
             ragConfig=ragConfig,
             useRAG=useRAG,
             kgConfig=kgConfig,
             useKG=useKG,
+            httpClients=httpClients,
         )
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        # like achat(), take the slot before the session lock: the slot covers
+        # the RAG/KG lookups too, and the same order on both paths means a
+        # stream holding the lock never waits on chats queued for it
+        async with _openai_semaphore():
+            conversation = await asyncio.to_thread(
+                get_conversation, self.sessionId, self.modelConfig
+            )
+            await _acquire(conversation.lock)
+            try:
+                text = await asyncio.to_thread(
+                    _prepare_stream, conversation, self._query
+                )
+                if text is None:
+                    return
+                self.contexts = conversation.get_last_contexts()
+                async for delta in conversation.stream(text):
+                    yield delta
+            finally:
+                conversation.lock.release()
+
+
+def _prepare_stream(conversation: SessionData, query: dict) -> Optional[str]:
+    try:
+        return conversation.prepare_stream(**query)
     except Exception as e:
         logger.error(e)
         raise e
-    finally:
-        rlock.release()
 
 
 def recycle_conversations():
@@ -1,6 +1,15 @@
 
+import asyncio
+from collections import OrderedDict
+import grpc
+from threading import Lock
 from biochatter.vectorstore import DocumentEmbedder, DocumentReader
-from typing import Any, Dict, List, Optional
+from biochatter.vectorstore_agent import VectorDatabaseAgentMilvus
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from pymilvus import MilvusException, connections
+import pymilvus
 import logging
 from src.constants import (
     ARGS_CHUNK_SIZE,
@@ -10,57 +19,211 @@ from src.constants import (
     ARGS_SPLIT_BY_CHAR
 )
 
-from src.utils import get_azure_embedding_deployment
+from src.utils import (
+    get_azure_embedding_deployment,
+    get_embedding_function,
+    get_limit_semaphore,
+)
 
 logger = logging.getLogger(__name__)
 
-def new_embedder_document(
-        authKey: str, 
-        tmpFile: str, 
-        filename: str, 
-        rag_config: Any
-    ):
-    api_key = authKey
+# OpenAI rejects embedding requests with more than 2048 inputs
+MAX_EMBEDDING_ARRAY_DIMENSIONS = 2048
+
+class PrecomputedEmbeddings(Embeddings):
+    """
+    Serves vectors that were computed ahead of time, so storing documents
+    does not embed the same chunks a second time. Unknown texts and queries
+    fall back to the wrapped embeddings.
+    """
+    def __init__(
+            self,
+            embeddings: Embeddings,
+            texts: Optional[List[str]] = None,
+            vectors: Optional[List[List[float]]] = None
+        ):
+        self._embeddings = embeddings
+        self._vectors = dict(zip(texts or [], vectors or []))
+
+    def add(self, texts: List[str], vectors: List[List[float]]):
+        self._vectors.update(zip(texts, vectors))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        missing = [text for text in texts if text not in self._vectors]
+        if len(missing) > 0:
+            self._vectors.update(
+                zip(missing, self._embeddings.embed_documents(missing))
+            )
+        return [self._vectors[text] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embeddings.embed_query(text)
+
+def _embedding_semaphore() -> asyncio.Semaphore:
+    # bounds the embedding requests in flight against the OpenAI API across
+    # all uploads
+    return get_limit_semaphore("EMB_MAX_INFLIGHT", 8)
+
+async def _embed_window(
+        embeddings: Embeddings,
+        texts: List[str]
+    ) -> List[List[float]]:
+    async with _embedding_semaphore():
+        # langchain's aembed_documents still tokenizes (and on first use
+        # downloads the tokenizer) synchronously, so embed on a worker thread
+        return await asyncio.to_thread(embeddings.embed_documents, texts)
+
+def _create_embeddings(authKey: str) -> Embeddings:
     (is_azure, azure_deployment, endpoint) = get_azure_embedding_deployment()
-    rag_agent = DocumentEmbedder(
+    return get_embedding_function(
+        is_azure=is_azure,
+        api_key=authKey,
+        azure_deployment=azure_deployment,
+        azure_endpoint=endpoint,
+    )
+
+def _create_document_embedder(
+        rag_config: Any,
+        embeddings: Embeddings
+    ) -> DocumentEmbedder:
+    return DocumentEmbedder(
       used=True,
       chunk_size=rag_config[ARGS_CHUNK_SIZE],
       chunk_overlap=rag_config[ARGS_OVERLAP_SIZE],
       split_by_characters=rag_config[ARGS_SPLIT_BY_CHAR],
       n_results=rag_config[ARGS_RESULT_NUM],
-      api_key=api_key,
-      is_azure=is_azure,
-      azure_deployment=azure_deployment,
-      azure_endpoint=endpoint,
+      embeddings=embeddings,
       connection_args=rag_config[ARGS_CONNECTION_ARGS]
     )
-    rag_agent.connect()
+
+def split_document(
+        authKey: str,
+        tmpFile: str,
+        filename: str,
+        rag_config: Any
+    ) -> List[Document]:
+    rag_agent = _create_document_embedder(
+        rag_config, _create_embeddings(authKey)
+    )
     reader = DocumentReader()
     docs = reader.load_document(tmpFile)
     if len(docs) > 0:
         for doc in docs:
             doc.metadata.update({"source": filename})
-    logger.info('save_document')
-    logger.error('save_document')
-    return rag_agent.save_document(docs)
+    return rag_agent._split_document(docs)
 
-def get_all_documents(
-        authKey: str, 
-        connection_args: Dict, 
-        doc_ids: Optional[List[str]] = None
-    ):
-    api_key = authKey
+async def embed_chunks(
+        authKey: str,
+        chunks: List[Document]
+    ) -> List[List[float]]:
+    embeddings = _create_embeddings(authKey)
+    texts = [chunk.page_content for chunk in chunks]
+    windows = [
+        texts[i:i + MAX_EMBEDDING_ARRAY_DIMENSIONS]
+        for i in range(0, len(texts), MAX_EMBEDDING_ARRAY_DIMENSIONS)
+    ]
+    results = await asyncio.gather(
+        *[_embed_window(embeddings, window) for window in windows]
+    )
+    return [vector for result in results for vector in result]
+
+# connected Milvus hosts, keyed by their connection arguments, so that
+# listing and removing documents do not open a new connection every time.
+# Connection arguments come from the client, so only the most recently used
+# hosts are kept and the others are disconnected
+MAX_CACHED_CONNECTIONS = 16
+_conn_cache: "OrderedDict[Tuple, VectorDatabaseAgentMilvus]" = OrderedDict()
+_conn_cache_lock = Lock()
+
+def _connection_key(connection_args: Dict) -> Tuple:
+    return tuple(sorted(
+        (key, str(val)) for (key, val) in connection_args.items()
+    ))
+
+def _disconnect(host: VectorDatabaseAgentMilvus):
+    try:
+        connections.disconnect(host.alias)
+    except Exception as e:
+        logger.warning(f"failed to disconnect Milvus alias {host.alias}: {e}")
+
+def _connect_database_host(
+        authKey: str,
+        connection_args: Dict
+    ) -> VectorDatabaseAgentMilvus:
     (is_azure, azure_deployment, endpoint) = get_azure_embedding_deployment()
     rag_agent = DocumentEmbedder(
-        api_key=api_key,
-        connection_args=connection_args,
-        documentids_workspace=doc_ids,
+        api_key=authKey,
+        connection_args=dict(connection_args),
         is_azure=is_azure,
         azure_endpoint=endpoint,
         azure_deployment=azure_deployment,
     )
     rag_agent.connect()
-    return rag_agent.get_all_documents()
+    return rag_agent.database_host
+
+def _get_cached_host(key: Tuple) -> Optional[VectorDatabaseAgentMilvus]:
+    with _conn_cache_lock:
+        host = _conn_cache.get(key)
+        if host is not None:
+            _conn_cache.move_to_end(key)
+        return host
+
+def _cache_host(
+        key: Tuple,
+        host: VectorDatabaseAgentMilvus
+    ) -> VectorDatabaseAgentMilvus:
+    evicted = []
+    with _conn_cache_lock:
+        if key in _conn_cache:
+            # another request connected to the same host meanwhile
+            evicted.append(host)
+            host = _conn_cache[key]
+            _conn_cache.move_to_end(key)
+        else:
+            _conn_cache[key] = host
+            while len(_conn_cache) > MAX_CACHED_CONNECTIONS:
+                evicted.append(_conn_cache.popitem(last=False)[1])
+    for stale in evicted:
+        _disconnect(stale)
+    return host
+
+def _drop_host(key: Tuple, host: VectorDatabaseAgentMilvus):
+    with _conn_cache_lock:
+        if _conn_cache.get(key) is host:
+            del _conn_cache[key]
+    _disconnect(host)
+
+def _run_on_database_host(
+        authKey: str,
+        connection_args: Dict,
+        func: Callable[[VectorDatabaseAgentMilvus], Any]
+    ) -> Any:
+    key = _connection_key(connection_args)
+    host = _get_cached_host(key)
+    if host is not None:
+        try:
+            return func(host)
+        except (MilvusException, grpc.RpcError) as e:
+            if (
+                isinstance(e, MilvusException)
+                and e.code != pymilvus.Status.CONNECT_FAILED
+            ):
+                raise e
+            # the cached connection went stale, reconnect once
+            _drop_host(key, host)
+    host = _cache_host(key, _connect_database_host(authKey, connection_args))
+    return func(host)
+
+def get_all_documents(
+        authKey: str, 
+        connection_args: Dict, 
+        doc_ids: Optional[List[str]] = None
+    ):
+    return _run_on_database_host(
+        authKey,
+        connection_args,
+        lambda host: host.get_all_documents(doc_ids=doc_ids),
+    )
 
 def remove_document(
         docId: str, 
@@ -68,18 +231,11 @@ def remove_document(
         connection_args, 
         doc_ids: Optional[List[str]] = None
     ):
-    api_key = authKey
-    (is_azure, azure_deployment, endpoint) = get_azure_embedding_deployment()
-    rag_agent = DocumentEmbedder(
-        api_key=api_key,
-        connection_args=connection_args,
-        documentids_workspace=doc_ids,
-        is_azure=is_azure,
-        azure_deployment=azure_deployment,
-        azure_endpoint=endpoint
+    _run_on_database_host(
+        authKey,
+        connection_args,
+        lambda host: host.remove_document(docId, doc_ids),
     )
-    rag_agent.connect()
-    rag_agent.remove_document(doc_id=docId)
 
 def get_connection_status(
         connection_args: Optional[Dict]=None, 
@@ -100,3 +256,119 @@ def get_connection_status(
         return True
     except Exception as e:
         return False
+
+def connect_document_embedder(
+        authKey: str,
+        rag_config: Any
+    ) -> Tuple[DocumentEmbedder, PrecomputedEmbeddings]:
+    """
+    Connect to the Milvus host of `rag_config`. Vectors added to the returned
+    PrecomputedEmbeddings are used when storing chunks over the connection.
+    """
+    embeddings = PrecomputedEmbeddings(_create_embeddings(authKey))
+    rag_agent = _create_document_embedder(rag_config, embeddings)
+    rag_agent.connect()
+    return (rag_agent, embeddings)
+
+def store_chunks(rag_agent: DocumentEmbedder, chunks: List[Document]) -> str:
+    logger.info('save_document')
+    return rag_agent.database_host.store_embeddings(documents=chunks)
+
+async def anew_embedder_document(
+        authKey: str,
+        tmpFile: str,
+        filename: str,
+        rag_config: Any
+    ):
+    (result,) = await anew_embedder_documents(
+        authKey, [(tmpFile, filename)], rag_config
+    )
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+async def anew_embedder_documents(
+        authKey: str,
+        files: List[Tuple[str, str]],
+        rag_config: Any
+    ) -> List[Any]:
+    """
+    Embed and store several (tmpFile, filename) pairs in one go: every chunk
+    of every file goes through a single embed_chunks call, and the files are
+    inserted concurrently over one Milvus connection. Returns one document id
+    or exception per file, in the order of `files`.
+    """
+    if len(files) == 0:
+        return []
+    # connect while splitting, so an unreachable Milvus fails the upload
+    # before any chunk is sent off for embedding
+    (connected, *results) = await asyncio.gather(
+        asyncio.to_thread(connect_document_embedder, authKey, rag_config),
+        *[
+            asyncio.to_thread(
+                split_document, authKey, tmpFile, filename, rag_config
+            )
+            for (tmpFile, filename) in files
+        ],
+        return_exceptions=True,
+    )
+    split_indices = [
+        ix for ix, res in enumerate(results) if not isinstance(res, BaseException)
+    ]
+    if isinstance(connected, BaseException):
+        logger.error(connected)
+        for ix in split_indices:
+            results[ix] = connected
+        return results
+    (rag_agent, embeddings) = connected
+    try:
+        if len(split_indices) == 0:
+            return results
+        all_chunks = [chunk for ix in split_indices for chunk in results[ix]]
+        try:
+            vectors = await embed_chunks(authKey, all_chunks)
+        except Exception as e:
+            logger.error(e)
+            for ix in split_indices:
+                results[ix] = e
+            return results
+        embeddings.add([chunk.page_content for chunk in all_chunks], vectors)
+        inserted = await asyncio.gather(
+            *[
+                asyncio.to_thread(store_chunks, rag_agent, results[ix])
+                for ix in split_indices
+            ],
+            return_exceptions=True,
+        )
+        for ix, res in zip(split_indices, inserted):
+            results[ix] = res
+        return results
+    finally:
+        await asyncio.to_thread(_disconnect, rag_agent.database_host)
+
+async def aget_all_documents(
+        authKey: str,
+        connection_args: Dict,
+        doc_ids: Optional[List[str]] = None
+    ):
+    return await asyncio.to_thread(
+        get_all_documents, authKey, connection_args, doc_ids
+    )
+
+async def aremove_document(
+        docId: str,
+        authKey: str,
+        connection_args,
+        doc_ids: Optional[List[str]] = None
+    ):
+    return await asyncio.to_thread(
+        remove_document, docId, authKey, connection_args, doc_ids
+    )
+
+async def aget_connection_status(
+        connection_args: Optional[Dict]=None,
+        authKey: Optional[str] = None
+    ) -> bool:
+    return await asyncio.to_thread(
+        get_connection_status, connection_args, authKey
+    )
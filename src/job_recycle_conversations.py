@@ -1,7 +1,6 @@
 
 import schedule
 import threading
-import time
 
 from src.conversation_manager import recycle_conversations
 
@@ -22,7 +21,7 @@ def run_scheduled_job_continuously(interval=60):
         def run(cls):
             while not cease_continuous_run.is_set():
                 schedule.run_pending()
-                time.sleep(interval)
+                cease_continuous_run.wait(interval)
             print("exiting job thread ...")
 
     continuous_thread = ScheduleThread()
@@ -1,3 +1,4 @@
+import asyncio
 import json
 from typing import Optional
 from biochatter.rag_agent import RagAgent, RagAgentModeEnum
@@ -45,3 +46,6 @@ def get_connection_status(connection_args: Optional[dict]):
     except Exception as e:
         logger.error(e)
         return False
+
+async def aget_connection_status(connection_args: Optional[dict]):
+    return await asyncio.to_thread(get_connection_status, connection_args)
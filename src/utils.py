@@ -1,12 +1,31 @@
 
 from typing import List, Optional, Tuple
+import asyncio
 import os
+import weakref
 
-from flask import Request
+from starlette.requests import Request
 from src.constants import OPENAI_API_KEY
 from langchain.embeddings import OpenAIEmbeddings
 from langchain.embeddings.azure_openai import AzureOpenAIEmbeddings
 
+# event loop -> {environment variable name: semaphore}
+_loop_semaphores = weakref.WeakKeyDictionary()
+
+def get_limit_semaphore(env_name: str, default: int) -> asyncio.Semaphore:
+    """
+    Semaphore of the running event loop sized by the environment variable
+    `env_name`. There is one per loop, as an asyncio.Semaphore belongs to
+    the loop that first waits on it; it is read on first use, after .env has
+    been loaded.
+    """
+    semaphores = _loop_semaphores.setdefault(asyncio.get_running_loop(), {})
+    if env_name not in semaphores:
+        semaphores[env_name] = asyncio.Semaphore(
+            int(os.environ.get(env_name, default))
+        )
+    return semaphores[env_name]
+
 def parse_api_key(bearToken: str) -> str:
     if not bearToken:
         return ""
@@ -23,15 +42,13 @@ def get_rag_agent_prompts() -> List[str]:
         "you: {statements}",
     ]
 
-def get_auth(request):
+def get_auth(request: Request) -> str:
     # If OPENAI_API_KEY is provided by server, we will use it
     if OPENAI_API_KEY in os.environ and os.environ[OPENAI_API_KEY]:
         return os.environ[OPENAI_API_KEY]
     
     # Otherwise, we will parse it from request
-    auth = request.headers.get("Authorization")
-    auth = auth if auth is not None and len(auth) > 0 else ""
-    return parse_api_key(auth)
+    return parse_api_key(request.headers.get("Authorization", ""))
 
 def get_azure_embedding_deployment() -> Tuple[bool, str, str]:
     is_azure = os.environ.get("OPENAI_API_TYPE", "") == "azure"
@@ -0,0 +1,13 @@
+import sys
+
+import pytest
+
+
+@pytest.fixture(scope="session", autouse=True)
+def stop_scheduled_job():
+    yield
+    # app.py starts the non-daemon recycle thread on import, which would keep
+    # the test process alive
+    app = sys.modules.get("app")
+    if app is not None:
+        app.cease_event.set()
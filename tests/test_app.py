@@ -0,0 +1,375 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+import orjson
+import pymilvus
+from pymilvus import MilvusException
+from starlette.middleware.cors import CORSMiddleware
+
+import app
+from src.constants import (
+    ERROR_BATCH_TOO_LARGE,
+    ERROR_MILVUS_CONNECT_FAILED,
+    ERROR_MILVUS_UNKNOWN,
+    ERROR_OK,
+    ERROR_UNKNOW,
+    ERRSTR_MILVUS_CONNECT_FAILED,
+)
+
+client = TestClient(app.app)
+
+
+def test_new_documents(monkeypatch):
+    calls = []
+
+    async def anew_embedder_documents(authKey, files, rag_config):
+        calls.append(files)
+        return ["1", ValueError("cannot read b.pdf"), "3"]
+
+    monkeypatch.setattr(app, "anew_embedder_documents", anew_embedder_documents)
+    res = client.post(
+        "/v1/rag/newdocuments",
+        json={
+            "files": [
+                {"tmpFile": "/tmp/a", "filename": "a.pdf"},
+                {"tmpFile": "/tmp/b", "filename": "b.pdf"},
+                {"tmpFile": "/tmp/c", "filename": "c.pdf"},
+            ]
+        },
+    )
+    assert calls == [[("/tmp/a", "a.pdf"), ("/tmp/b", "b.pdf"), ("/tmp/c", "c.pdf")]]
+    assert res.json() == {
+        "results": [
+            {"file": "a.pdf", "id": "1", "code": ERROR_OK},
+            {"file": "b.pdf", "error": "cannot read b.pdf", "code": ERROR_UNKNOW},
+            {"file": "c.pdf", "id": "3", "code": ERROR_OK},
+        ],
+        "code": ERROR_OK,
+    }
+
+
+def test_new_documents_batch_too_large(monkeypatch):
+    async def anew_embedder_documents(authKey, files, rag_config):
+        raise AssertionError("a rejected batch must not be embedded")
+
+    monkeypatch.setattr(app, "anew_embedder_documents", anew_embedder_documents)
+    files = [
+        {"tmpFile": f"/tmp/{ix}", "filename": f"{ix}.pdf"}
+        for ix in range(app.MAX_BATCH_SIZE + 1)
+    ]
+    res = client.post("/v1/rag/newdocuments", json={"files": files})
+    assert res.json()["code"] == ERROR_BATCH_TOO_LARGE
+
+
+def test_new_documents_empty(monkeypatch):
+    async def anew_embedder_documents(authKey, files, rag_config):
+        return []
+
+    monkeypatch.setattr(app, "anew_embedder_documents", anew_embedder_documents)
+    res = client.post("/v1/rag/newdocuments", json={"files": []})
+    assert res.json() == {"results": [], "code": ERROR_OK}
+
+
+def test_process_connection_args_unhashable_values(monkeypatch):
+    monkeypatch.setenv("HOST", "milvus")
+    args = app.process_connection_args(
+        app.RAG_VECTORSTORE, {"host": "local", "extra": [1]}
+    )
+    assert args == {"host": "milvus", "extra": [1]}
+
+
+class FakeStream:
+    def __init__(self, deltas, error=None):
+        self.deltas = deltas
+        self.error = error
+        self.contexts = []
+
+    async def __aiter__(self):
+        for delta in self.deltas:
+            yield delta
+        if self.error is not None:
+            raise self.error
+        self.contexts = [{"mode": "vectorstore", "context": ["doc"]}]
+
+
+def _sse_events(stream):
+    async def collect():
+        return [event async for event in app.sse_formatter("gpt-4", stream)]
+
+    events = asyncio.run(collect())
+    assert all(
+        event.startswith(b"data: ") and event.endswith(b"\n\n") for event in events
+    )
+    assert events[-1] == b"data: [DONE]\n\n"
+    return [orjson.loads(event[len(b"data: "):]) for event in events[:-1]]
+
+
+def test_sse_formatter():
+    events = _sse_events(FakeStream(["Hel", "lo"]))
+    assert len(events) == 3
+    assert len({event["id"] for event in events}) == 1
+    assert [event["object"] for event in events] == ["chat.completion.chunk"] * 3
+    assert [event["model"] for event in events] == ["gpt-4"] * 3
+    assert [event["choices"] for event in events[:2]] == [
+        [
+            {
+                "index": 0,
+                "delta": {"role": "assistant", "content": delta},
+                "finish_reason": None,
+            }
+        ]
+        for delta in ["Hel", "lo"]
+    ]
+    assert events[2]["choices"] == [
+        {"index": 0, "delta": {}, "finish_reason": "stop"}
+    ]
+    assert events[2]["contexts"] == [{"mode": "vectorstore", "context": ["doc"]}]
+    assert events[2]["code"] == ERROR_OK
+
+
+def test_sse_formatter_error_mid_stream():
+    events = _sse_events(
+        FakeStream(
+            ["Hel"],
+            error=MilvusException(
+                code=pymilvus.Status.CONNECT_FAILED, message="unreachable"
+            ),
+        )
+    )
+    assert len(events) == 2
+    assert events[0]["choices"][0]["delta"]["content"] == "Hel"
+    assert events[1] == {
+        "error": ERRSTR_MILVUS_CONNECT_FAILED,
+        "code": ERROR_MILVUS_CONNECT_FAILED,
+    }
+
+
+def test_build_rag_config(monkeypatch):
+    monkeypatch.setenv("HOST", "milvus")
+    app._resolve_connection_args.cache_clear()
+    ragConfig = {"chunkSize": 500, "connectionArgs": {"host": "local", "port": "1"}}
+    config = app.build_rag_config(ragConfig)
+    assert config == {
+        **app.DEFAULT_RAGCONFIG,
+        "chunkSize": 500,
+        "connectionArgs": {"host": "milvus", "port": "1"},
+    }
+    # neither the request nor the defaults are changed
+    assert ragConfig["connectionArgs"] == {"host": "local", "port": "1"}
+    config["connectionArgs"]["user"] = "someone"
+    assert app.DEFAULT_RAGCONFIG["connectionArgs"] == {}
+    assert app.build_rag_config(None)["connectionArgs"] == {}
+
+
+def test_build_rag_config_without_connection_args():
+    for ragConfig in [{"chunkSize": 500}, {"connectionArgs": None}, "{}"]:
+        assert app.build_rag_config(ragConfig)["connectionArgs"] == {}
+
+
+def test_build_kg_config(monkeypatch):
+    monkeypatch.setenv("KGHOST", "neo4j")
+    app._resolve_connection_args.cache_clear()
+    kgConfig = {"resultNum": 5, "connectionArgs": {"host": "local"}}
+    assert app.build_kg_config(kgConfig) == {
+        "resultNum": 5,
+        "connectionArgs": {"host": "neo4j"},
+    }
+    assert kgConfig["connectionArgs"] == {"host": "local"}
+    assert app.build_kg_config(None) == {}
+    assert app.build_kg_config({"connectionArgs": None}) == {}
+
+
+def _cors_headers(response) -> dict:
+    return {
+        key: val
+        for (key, val) in response.headers.items()
+        if key.startswith("access-control-") or key == "vary"
+    }
+
+
+def _starlette_preflight_client() -> TestClient:
+    (cors_options,) = [
+        middleware.kwargs
+        for middleware in app.app.user_middleware
+        if middleware.cls is CORSMiddleware
+    ]
+    return TestClient(CORSMiddleware(app.app.router, **cors_options))
+
+
+def test_preflight_matches_cors_middleware():
+    starlette_client = _starlette_preflight_client()
+    for request_headers in [
+        {},
+        {"Access-Control-Request-Headers": "authorization,content-type"},
+    ]:
+        headers = {
+            "Origin": "https://chat.example.org",
+            "Access-Control-Request-Method": "POST",
+            **request_headers,
+        }
+        expected = starlette_client.options(
+            "/v1/chat/completions", headers=headers
+        )
+        res = client.options("/v1/chat/completions", headers=headers)
+        assert res.status_code == expected.status_code == 200
+        assert _cors_headers(res) == _cors_headers(expected)
+
+
+def test_plain_options_reaches_app():
+    res = client.options(
+        "/v1/chat/completions", headers={"Origin": "https://chat.example.org"}
+    )
+    # not a preflight, so the router answers (the route only allows POST)
+    assert res.status_code == 405
+    assert res.headers["access-control-allow-origin"] == "*"
+
+
+def test_lifespan_can_run_twice():
+    for _ in range(2):
+        with TestClient(app.app) as lifespan_client:
+            assert lifespan_client.app.state.http_clients is not None
+    # logging still goes through the listener after a shutdown
+    assert app.root_logger._biochat_log_listener._thread is not None
+
+
+def test_chat_creates_session_with_request_config(monkeypatch):
+    calls = []
+
+    async def achat(*args):
+        calls.append(args)
+        return ("answer", {"total_tokens": 1}, [])
+
+    monkeypatch.setattr(app, "achat", achat)
+    res = client.post(
+        "/v1/chat/completions",
+        headers={"Authorization": "Bearer sk-1"},
+        json={
+            "session_id": "s",
+            "messages": [{"role": "user", "content": "question"}],
+            "model": "gpt-4",
+            "temperature": 0.2,
+        },
+    )
+    assert res.json()["choices"][0]["message"]["content"] == "answer"
+    modelConfig = calls[0][-1]
+    assert modelConfig == {
+        "temperature": 0.2,
+        "presence_penalty": 0,
+        "frequency_penalty": 0,
+        "top_p": 1,
+        "model": "gpt-4",
+        "auth": "sk-1",
+    }
+
+
+def test_chat_request_defaults(monkeypatch):
+    calls = []
+
+    async def achat(*args):
+        calls.append(args)
+        return ("answer", {}, [])
+
+    monkeypatch.setattr(app, "achat", achat)
+    # unknown fields are ignored like before
+    res = client.post("/v1/chat/completions", json={"unknown": 1})
+    assert res.status_code == 200
+    (
+        sessionId,
+        messages,
+        auth,
+        ragConfig,
+        useRAG,
+        kgConfig,
+        useKG,
+        _,
+        modelConfig,
+    ) = calls[0]
+    assert (sessionId, messages, useRAG, kgConfig, useKG) == ("", [], False, {}, False)
+    assert ragConfig == dict(app.DEFAULT_RAGCONFIG)
+    assert {key: val for (key, val) in modelConfig.items() if key != "auth"} == {
+        "model": "gpt-3.5-turbo",
+        "temperature": 0.7,
+        "presence_penalty": 0,
+        "frequency_penalty": 0,
+        "top_p": 1,
+    }
+
+
+def test_document_request_defaults():
+    assert app.NewDocumentRequest().dict() == {
+        "tmpFile": "",
+        "filename": "",
+        "ragConfig": None,
+    }
+    assert app.NewDocumentsRequest().files == []
+    assert app.RemoveDocumentRequest().dict() == {
+        "connectionArgs": None,
+        "docIds": None,
+        "docId": "",
+    }
+    assert app.ConnectionStatusRequest().connectionArgs is None
+
+
+def test_malformed_requests_are_rejected(monkeypatch):
+    async def unexpected(*args, **kwargs):
+        raise AssertionError("malformed requests must not get this far")
+
+    monkeypatch.setattr(app, "achat", unexpected)
+    monkeypatch.setattr(app, "anew_embedder_document", unexpected)
+    monkeypatch.setattr(app, "anew_embedder_documents", unexpected)
+    for (path, body) in [
+        ("/v1/chat/completions", {"messages": "question"}),
+        ("/v1/chat/completions", {"temperature": "hot"}),
+        ("/v1/chat/completions", {"ragConfig": [1]}),
+        ("/v1/rag/newdocument", {"tmpFile": ["/tmp/a"]}),
+        ("/v1/rag/newdocuments", {"files": {"tmpFile": "/tmp/a"}}),
+    ]:
+        assert client.post(path, json=body).status_code == 422
+    assert client.post("/v1/chat/completions", content=b"not json").status_code == 422
+
+
+def _raise_from_alldocuments(monkeypatch, error):
+    async def aget_all_documents(*args, **kwargs):
+        raise error
+
+    monkeypatch.setattr(app, "aget_all_documents", aget_all_documents)
+    return client.post(
+        "/v1/rag/alldocuments",
+        json={},
+        headers={"Origin": "http://localhost:3000"},
+    )
+
+
+def test_error_milvus_connect_failed(monkeypatch):
+    error = MilvusException(code=pymilvus.Status.CONNECT_FAILED, message="down")
+    res = _raise_from_alldocuments(monkeypatch, error)
+    assert res.json() == {
+        "error": ERRSTR_MILVUS_CONNECT_FAILED,
+        "code": ERROR_MILVUS_CONNECT_FAILED,
+    }
+    assert res.headers["access-control-allow-origin"] == "*"
+
+
+def test_error_milvus_connect_failed_headers_do_not_accumulate(monkeypatch):
+    error = MilvusException(code=pymilvus.Status.CONNECT_FAILED, message="down")
+    first = _raise_from_alldocuments(monkeypatch, error)
+    second = _raise_from_alldocuments(monkeypatch, error)
+    assert first.content == second.content
+    assert first.headers.items() == second.headers.items()
+    assert len(second.headers.get_list("access-control-allow-origin")) == 1
+    assert second.headers["content-length"] == str(len(second.content))
+
+
+def test_error_milvus_other(monkeypatch):
+    error = MilvusException(
+        code=pymilvus.Status.COLLECTION_NOT_EXISTS, message="no such collection"
+    )
+    res = _raise_from_alldocuments(monkeypatch, error)
+    assert res.json() == {"error": "no such collection", "code": ERROR_MILVUS_UNKNOWN}
+    assert res.headers["access-control-allow-origin"] == "*"
+
+
+def test_error_unknown(monkeypatch):
+    res = _raise_from_alldocuments(monkeypatch, ValueError("bad document id"))
+    assert res.json() == {"error": "bad document id", "code": ERROR_UNKNOW}
+    assert res.headers["access-control-allow-origin"] == "*"
@@ -1,11 +1,16 @@
 
+import asyncio
+import threading
+import time
+
+from src import conversation_manager
 from src.conversation_manager import (
     get_conversation, 
     has_conversation,
     initialize_conversation, 
-    parse_api_key,
     remove_conversation
 )
+from src.utils import parse_api_key
 
 def test_parse_api_key():
     res = parse_api_key("Bearer balahbalah")
@@ -39,3 +44,196 @@ def test_remove_conversation():
     assert not has_conversation(sessionId)
 
 
+
+class FakeConversation:
+    def __init__(self, text="question"):
+        self.lock = threading.Lock()
+        self.text = text
+        self.messages = []
+
+    def prepare_stream(self, messages, **kwargs):
+        return self.text
+
+    def get_last_contexts(self):
+        return [{"mode": "vectorstore", "context": ["doc"]}]
+
+    async def stream(self, text):
+        for delta in ["Hel", "lo"]:
+            assert self.lock.locked()
+            yield delta
+        self.messages.append(("ai", "Hello"))
+
+def _serve(monkeypatch, conversation):
+    monkeypatch.setattr(
+        conversation_manager,
+        "get_conversation",
+        lambda sessionId, modelConfig=None: conversation,
+    )
+
+def _consume(stream):
+    async def consume():
+        return [delta async for delta in stream]
+    return asyncio.run(consume())
+
+def test_chat_stream(monkeypatch):
+    conversation = FakeConversation()
+    _serve(monkeypatch, conversation)
+    stream = conversation_manager.ChatStream(
+        "s", [{"role": "user", "content": "question"}], "key", {}, False, {}, False
+    )
+    assert _consume(stream) == ["Hel", "lo"]
+    assert stream.contexts == [{"mode": "vectorstore", "context": ["doc"]}]
+    assert conversation.messages == [("ai", "Hello")]
+    assert not conversation.lock.locked()
+
+def test_chat_stream_waits_for_session(monkeypatch):
+    conversation = FakeConversation()
+    _serve(monkeypatch, conversation)
+    conversation.lock.acquire()
+    # another query of the session finishes a little later
+    threading.Timer(0.2, conversation.lock.release).start()
+    stream = conversation_manager.ChatStream("s", [], "key", {}, False, {}, False)
+    assert _consume(stream) == ["Hel", "lo"]
+    assert not conversation.lock.locked()
+
+def test_chat_stream_nothing_to_answer(monkeypatch):
+    conversation = FakeConversation(text=None)
+    _serve(monkeypatch, conversation)
+    stream = conversation_manager.ChatStream("s", [], "", {}, False, {}, False)
+    assert _consume(stream) == []
+    assert stream.contexts == []
+    assert not conversation.lock.locked()
+
+def test_achat_bounds_chats_in_flight(monkeypatch):
+    monkeypatch.setenv("OAI_MAX_INFLIGHT", "2")
+    in_flight = []
+    peak = []
+
+    def chat(sessionId, *args):
+        in_flight.append(sessionId)
+        peak.append(len(in_flight))
+        time.sleep(0.05)
+        in_flight.remove(sessionId)
+        return (sessionId, {}, [])
+
+    monkeypatch.setattr(conversation_manager, "chat", chat)
+
+    async def chats():
+        return await asyncio.gather(*[
+            conversation_manager.achat(f"s{ix}", [], "key", {}, False, {}, False)
+            for ix in range(6)
+        ])
+
+    # a fresh event loop per run must get its own semaphore
+    for _ in range(2):
+        results = asyncio.run(chats())
+        assert [msg for (msg, _, _) in results] == [f"s{ix}" for ix in range(6)]
+    assert max(peak) == 2
+
+def test_chat_locks_only_its_session(monkeypatch):
+    conversations = {}
+    in_flight = []
+    peak = []
+
+    class Conversation(FakeConversation):
+        def chat(self, **kwargs):
+            in_flight.append(self)
+            peak.append(len(in_flight))
+            time.sleep(0.05)
+            in_flight.remove(self)
+            return ("answer", {}, [])
+
+    monkeypatch.setattr(
+        conversation_manager,
+        "get_conversation",
+        lambda sessionId, modelConfig=None: conversations.setdefault(
+            sessionId, Conversation()
+        ),
+    )
+    threads = [
+        threading.Thread(
+            target=conversation_manager.chat,
+            args=(sessionId, [], "key", {}, False, {}, False),
+        )
+        for sessionId in ["a", "a", "b"]
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # the two sessions overlap, the two queries of session a do not
+    assert max(peak) == 2
+    assert len(peak) == 3
+
+def test_get_conversation_creates_session_outside_rlock(monkeypatch):
+    created = []
+
+    class Session:
+        def __init__(self, sessionId, modelConfig):
+            # setting up a conversation can call the OpenAI API, other
+            # sessions must not wait for it
+            other = threading.Thread(target=has_conversation, args=("other",))
+            other.start()
+            other.join(timeout=1)
+            assert not other.is_alive()
+            created.append(modelConfig)
+
+    monkeypatch.setattr(conversation_manager, "SessionData", Session)
+    monkeypatch.setattr(conversation_manager, "conversationsDict", {})
+    modelConfig = {"model": "gpt-4", "temperature": 0.2}
+    conversation = get_conversation("new", modelConfig)
+    assert get_conversation("new") is conversation
+    assert created == [modelConfig]
+
+def test_shared_http_clients_keep_model_settings():
+    import httpx
+    from langchain.chat_models import ChatOpenAI
+
+    session = conversation_manager.SessionData(
+        "shared-clients", conversation_manager.defaultModelConfig.copy()
+    )
+    settings = {
+        "openai_api_key": "sk-model",
+        "openai_api_base": "http://proxy.local/v1",
+        "openai_organization": "org-test",
+        "request_timeout": 12.0,
+        "max_retries": 5,
+    }
+    session.chatter.chat = ChatOpenAI(**settings)
+    session.chatter.ca_chat = ChatOpenAI(**settings)
+    http_client = httpx.Client()
+    async_http_client = httpx.AsyncClient()
+    session._share_http_clients("sk-shared", (http_client, async_http_client))
+    for chat_model in [session.chatter.chat, session.chatter.ca_chat]:
+        for (client, pool) in [
+            (chat_model.client._client, http_client),
+            (chat_model.async_client._client, async_http_client),
+        ]:
+            assert client._client is pool
+            assert client.api_key == "sk-shared"
+            assert str(client.base_url) == "http://proxy.local/v1/"
+            assert client.organization == "org-test"
+            assert client.timeout == 12.0
+            assert client.max_retries == 5
+    http_client.close()
+
+def test_chat_stream_slot_covers_lookups(monkeypatch):
+    monkeypatch.setenv("OAI_MAX_INFLIGHT", "1")
+    conversation = FakeConversation()
+    _serve(monkeypatch, conversation)
+
+    async def check():
+        semaphore = conversation_manager._openai_semaphore()
+        slots = []
+
+        def prepare_stream(**query):
+            # the RAG/KG lookups must already hold the chat slot
+            slots.append(semaphore.locked())
+            return "question"
+
+        conversation.prepare_stream = prepare_stream
+        stream = conversation_manager.ChatStream("s", [], "key", {}, True, {}, True)
+        deltas = [delta async for delta in stream]
+        return (deltas, slots, semaphore.locked())
+
+    assert asyncio.run(check()) == (["Hel", "lo"], [True], False)
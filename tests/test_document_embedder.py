@@ -0,0 +1,356 @@
+import asyncio
+from collections import OrderedDict
+import threading
+
+import grpc
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+import pymilvus
+from pymilvus import MilvusException
+import pytest
+
+import src.document_embedder as document_embedder
+
+
+def _chunks(filename: str, count: int):
+    return [
+        Document(page_content=f"{filename}-{ix}", metadata={"source": filename})
+        for ix in range(count)
+    ]
+
+
+def _patch_pipeline(
+        monkeypatch, split_failures=(), embed_error=None, connect_error=None
+    ):
+    stored = {}
+    connections = []
+
+    def split_document(authKey, tmpFile, filename, rag_config):
+        if filename in split_failures:
+            raise ValueError(f"cannot read {filename}")
+        return _chunks(filename, int(tmpFile))
+
+    def connect_document_embedder(authKey, rag_config):
+        connections.append("connect")
+        if connect_error is not None:
+            raise connect_error
+        embeddings = document_embedder.PrecomputedEmbeddings(FakeEmbeddings())
+        return (FakeDocumentEmbedder(embeddings), embeddings)
+
+    async def embed_chunks(authKey, chunks):
+        if embed_error is not None:
+            raise embed_error
+        return [[float(ix)] for ix in range(len(chunks))]
+
+    def store_chunks(rag_agent, chunks):
+        filename = chunks[0].metadata["source"]
+        stored[filename] = rag_agent.embeddings.embed_documents(
+            [chunk.page_content for chunk in chunks]
+        )
+        return f"id-{filename}"
+
+    monkeypatch.setattr(document_embedder, "split_document", split_document)
+    monkeypatch.setattr(
+        document_embedder, "connect_document_embedder", connect_document_embedder
+    )
+    monkeypatch.setattr(document_embedder, "embed_chunks", embed_chunks)
+    monkeypatch.setattr(document_embedder, "store_chunks", store_chunks)
+    monkeypatch.setattr(
+        document_embedder,
+        "_disconnect",
+        lambda host: connections.append("disconnect"),
+    )
+    return (stored, connections)
+
+
+def test_new_embedder_documents_keeps_file_order(monkeypatch):
+    (stored, connections) = _patch_pipeline(monkeypatch)
+    files = [("2", "a.pdf"), ("1", "b.pdf"), ("3", "c.pdf")]
+    results = asyncio.run(
+        document_embedder.anew_embedder_documents("key", files, {})
+    )
+    assert results == ["id-a.pdf", "id-b.pdf", "id-c.pdf"]
+    # every file gets the vectors of its own chunks
+    assert stored == {
+        "a.pdf": [[0.0], [1.0]],
+        "b.pdf": [[2.0]],
+        "c.pdf": [[3.0], [4.0], [5.0]],
+    }
+    # one Milvus connection for the whole batch, closed afterwards
+    assert connections == ["connect", "disconnect"]
+
+
+def test_new_embedder_documents_split_failure(monkeypatch):
+    (stored, _) = _patch_pipeline(monkeypatch, split_failures=("b.pdf",))
+    files = [("2", "a.pdf"), ("1", "b.pdf"), ("1", "c.pdf")]
+    results = asyncio.run(
+        document_embedder.anew_embedder_documents("key", files, {})
+    )
+    assert results[0] == "id-a.pdf"
+    assert isinstance(results[1], ValueError)
+    assert results[2] == "id-c.pdf"
+    assert stored == {"a.pdf": [[0.0], [1.0]], "c.pdf": [[2.0]]}
+
+
+def test_new_embedder_documents_embedding_failure(monkeypatch):
+    error = RuntimeError("rate limited")
+    (stored, connections) = _patch_pipeline(
+        monkeypatch, split_failures=("b.pdf",), embed_error=error
+    )
+    files = [("2", "a.pdf"), ("1", "b.pdf"), ("1", "c.pdf")]
+    results = asyncio.run(
+        document_embedder.anew_embedder_documents("key", files, {})
+    )
+    assert results[0] is error
+    assert isinstance(results[1], ValueError)
+    assert results[2] is error
+    assert stored == {}
+    assert connections == ["connect", "disconnect"]
+
+
+def test_new_embedder_documents_unreachable_milvus(monkeypatch):
+    error = MilvusException(
+        code=pymilvus.Status.CONNECT_FAILED, message="unreachable"
+    )
+    (stored, connections) = _patch_pipeline(
+        monkeypatch, split_failures=("b.pdf",), connect_error=error
+    )
+    files = [("2", "a.pdf"), ("1", "b.pdf")]
+    results = asyncio.run(
+        document_embedder.anew_embedder_documents("key", files, {})
+    )
+    assert results[0] is error
+    assert isinstance(results[1], ValueError)
+    assert stored == {}
+    assert connections == ["connect"]
+
+
+def test_new_embedder_documents_no_files(monkeypatch):
+    (stored, connections) = _patch_pipeline(monkeypatch)
+    assert asyncio.run(
+        document_embedder.anew_embedder_documents("key", [], {})
+    ) == []
+    assert stored == {}
+    assert connections == []
+
+
+class _Host:
+    def __init__(self, name: str):
+        self.alias = name
+
+
+def _patch_connections(monkeypatch, max_cached=16):
+    connected = []
+    disconnected = []
+
+    def connect_database_host(authKey, connection_args):
+        host = _Host(f"{connection_args['host']}-{len(connected)}")
+        connected.append(host.alias)
+        return host
+
+    monkeypatch.setattr(document_embedder, "_conn_cache", OrderedDict())
+    monkeypatch.setattr(document_embedder, "MAX_CACHED_CONNECTIONS", max_cached)
+    monkeypatch.setattr(
+        document_embedder, "_connect_database_host", connect_database_host
+    )
+    monkeypatch.setattr(
+        document_embedder.connections, "disconnect", disconnected.append
+    )
+    return (connected, disconnected)
+
+
+def test_run_on_database_host_reuses_connection(monkeypatch):
+    (connected, _) = _patch_connections(monkeypatch)
+    args = {"host": "milvus", "port": "19530"}
+    for _ in range(3):
+        alias = document_embedder._run_on_database_host(
+            "key", args, lambda host: host.alias
+        )
+    assert alias == "milvus-0"
+    assert connected == ["milvus-0"]
+
+
+def test_run_on_database_host_reconnects_stale_connection(monkeypatch):
+    (connected, disconnected) = _patch_connections(monkeypatch)
+    args = {"host": "milvus"}
+    document_embedder._run_on_database_host("key", args, lambda host: None)
+
+    def list_documents(host):
+        if host.alias == "milvus-0":
+            raise grpc.RpcError()
+        return host.alias
+
+    alias = document_embedder._run_on_database_host("key", args, list_documents)
+    assert alias == "milvus-1"
+    assert disconnected == ["milvus-0"]
+
+
+def test_run_on_database_host_connects_once_when_unreachable(monkeypatch):
+    attempts = []
+
+    def connect_database_host(authKey, connection_args):
+        attempts.append(connection_args)
+        raise MilvusException(
+            code=pymilvus.Status.CONNECT_FAILED, message="unreachable"
+        )
+
+    _patch_connections(monkeypatch)
+    monkeypatch.setattr(
+        document_embedder, "_connect_database_host", connect_database_host
+    )
+    with pytest.raises(MilvusException):
+        document_embedder._run_on_database_host(
+            "key", {"host": "milvus"}, lambda host: None
+        )
+    assert len(attempts) == 1
+
+
+def test_run_on_database_host_keeps_other_errors(monkeypatch):
+    (connected, disconnected) = _patch_connections(monkeypatch)
+    args = {"host": "milvus"}
+    document_embedder._run_on_database_host("key", args, lambda host: None)
+
+    def remove_document(host):
+        raise MilvusException(message="collection not found")
+
+    with pytest.raises(MilvusException):
+        document_embedder._run_on_database_host("key", args, remove_document)
+    assert connected == ["milvus-0"]
+    assert disconnected == []
+
+
+def test_connection_cache_evicts_least_recently_used(monkeypatch):
+    (connected, disconnected) = _patch_connections(monkeypatch, max_cached=2)
+    for name in ["a", "b", "a", "c"]:
+        document_embedder._run_on_database_host(
+            "key", {"host": name}, lambda host: None
+        )
+    assert connected == ["a-0", "b-1", "c-2"]
+    assert disconnected == ["b-1"]
+    assert len(document_embedder._conn_cache) == 2
+
+
+class FakeEmbeddings(Embeddings):
+    def __init__(self):
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append((list(texts), threading.current_thread()))
+        return [[float(text.split("-")[-1])] for text in texts]
+
+    def embed_query(self, text):
+        return [-1.0]
+
+
+def test_embed_chunks_windows(monkeypatch):
+    embeddings = FakeEmbeddings()
+    monkeypatch.setattr(document_embedder, "MAX_EMBEDDING_ARRAY_DIMENSIONS", 3)
+    monkeypatch.setattr(
+        document_embedder, "_create_embeddings", lambda authKey: embeddings
+    )
+    chunks = _chunks("a.pdf", 7)
+    vectors = asyncio.run(document_embedder.embed_chunks("key", chunks))
+    assert vectors == [[float(ix)] for ix in range(7)]
+    assert sorted(len(texts) for (texts, _) in embeddings.calls) == [1, 3, 3]
+    # the blocking embedding call never runs on the event loop's thread
+    assert all(
+        thread is not threading.main_thread() for (_, thread) in embeddings.calls
+    )
+    assert asyncio.run(document_embedder.embed_chunks("key", [])) == []
+
+
+def test_precomputed_embeddings():
+    wrapped = FakeEmbeddings()
+    embeddings = document_embedder.PrecomputedEmbeddings(
+        wrapped, ["a-0", "a-1"], [[10.0], [11.0]]
+    )
+    embeddings.add(["a-2"], [[12.0]])
+    assert embeddings.embed_documents(["a-2", "a-0", "a-1"]) == [
+        [12.0], [10.0], [11.0]
+    ]
+    assert wrapped.calls == []
+    # unknown texts and queries fall back to the wrapped embeddings
+    assert embeddings.embed_documents(["a-0", "b-5"]) == [[10.0], [5.0]]
+    assert [texts for (texts, _) in wrapped.calls] == [["b-5"]]
+    assert embeddings.embed_query("question") == [-1.0]
+
+
+class FakeHost:
+    def __init__(self, name="milvus"):
+        self.alias = name
+        self.stored = []
+
+
+class FakeDocumentEmbedder:
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.database_host = FakeHost()
+
+
+def _patch_single_upload(monkeypatch, connect_error=None, split_error=None):
+    events = []
+
+    def split_document(authKey, tmpFile, filename, rag_config):
+        if split_error is not None:
+            raise split_error
+        return _chunks(filename, 2)
+
+    def connect_document_embedder(authKey, rag_config):
+        events.append("connect")
+        if connect_error is not None:
+            raise connect_error
+        embeddings = document_embedder.PrecomputedEmbeddings(FakeEmbeddings())
+        return (FakeDocumentEmbedder(embeddings), embeddings)
+
+    async def embed_chunks(authKey, chunks):
+        events.append("embed")
+        return [[100.0 + ix] for ix in range(len(chunks))]
+
+    def store_chunks(rag_agent, chunks):
+        texts = [chunk.page_content for chunk in chunks]
+        events.append(("store", rag_agent.embeddings.embed_documents(texts)))
+        return "doc-id"
+
+    monkeypatch.setattr(document_embedder, "split_document", split_document)
+    monkeypatch.setattr(
+        document_embedder, "connect_document_embedder", connect_document_embedder
+    )
+    monkeypatch.setattr(document_embedder, "embed_chunks", embed_chunks)
+    monkeypatch.setattr(document_embedder, "store_chunks", store_chunks)
+    monkeypatch.setattr(
+        document_embedder, "_disconnect", lambda host: events.append("disconnect")
+    )
+    return events
+
+
+def _upload():
+    return asyncio.run(
+        document_embedder.anew_embedder_document("key", "/tmp/a", "a.pdf", {})
+    )
+
+
+def test_new_embedder_document(monkeypatch):
+    events = _patch_single_upload(monkeypatch)
+    assert _upload() == "doc-id"
+    # stored with the vectors computed before, not embedded a second time
+    assert events == [
+        "connect", "embed", ("store", [[100.0], [101.0]]), "disconnect"
+    ]
+
+
+def test_new_embedder_document_unreachable_milvus(monkeypatch):
+    error = MilvusException(
+        code=pymilvus.Status.CONNECT_FAILED, message="unreachable"
+    )
+    events = _patch_single_upload(monkeypatch, connect_error=error)
+    with pytest.raises(MilvusException):
+        _upload()
+    # nothing is sent off for embedding
+    assert events == ["connect"]
+
+
+def test_new_embedder_document_split_failure(monkeypatch):
+    events = _patch_single_upload(monkeypatch, split_error=ValueError("bad"))
+    with pytest.raises(ValueError):
+        _upload()
+    assert events == ["connect", "disconnect"]